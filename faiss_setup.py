@@ -3,3 +3,6 @@ import faiss
 
 GPU_RES = faiss.StandardGpuResources()
 GPU_RES.setTempMemoryFraction(0.1)
+# run Faiss on the null stream, which is pytorch's default stream, so that
+# searches are ordered with pytorch ops without synchronizing the device
+GPU_RES.setDefaultNullStreamAllDevices()
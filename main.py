@@ -162,9 +162,9 @@ def train():
         for i, examples in enumerate(dataloader):
             input_pc, label_pc, ratio = examples
             ratio = ratio.item()
-            # 1xBx3xN
-            input_pc = input_pc[0].to(DEVICE)
-            label_pc = label_pc[0].to(DEVICE)
+            # 1xBx3xN, batches are pinned by the dataloader
+            input_pc = input_pc[0].to(DEVICE, non_blocking=True)
+            label_pc = label_pc[0].to(DEVICE, non_blocking=True)
             model.set_input(input_pc, ratio, label_pc=label_pc)
             # run gradient decent and increment model.step
             model.optimize()
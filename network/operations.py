@@ -8,6 +8,16 @@ import sampling
 if torch.cuda.is_available():
     from faiss_setup import GPU_RES
 
+# KNN is computed with one batched distance matrix and topk as long as the
+# BxMxN matrix has at most this many entries, larger problems fall back to
+# per-sample Faiss searches. the matrix alone takes 1GB in float32 (2GB in
+# float64), topk needs additional workspace on top of it
+TOPK_KNN_MAX_ELEMENTS = 2 ** 28
+# store the running minimum distances of furthest point sampling in half
+# precision, which halves the memory traffic of the sampling kernel.
+# only enable it for point clouds normalized to the unit sphere
+FPS_HALF_TEMP = False
+
 
 def normalize_point_batch(pc, NCHW=True):
     """
@@ -24,56 +34,78 @@ def normalize_point_batch(pc, NCHW=True):
     dim_axis = 1 if NCHW else 2
     centroid = torch.mean(pc, dim=point_axis, keepdim=True)
     pc = pc - centroid
-    furthest_distance, _ = torch.max(
-        torch.sqrt(torch.sum(pc ** 2, dim=dim_axis, keepdim=True)), dim=point_axis, keepdim=True)
-    pc = pc / furthest_distance
+    # sqrt is monotonic, take it after the max on the [B, 1, 1] result
+    furthest_distance_sq, _ = torch.max(
+        torch.sum(pc * pc, dim=dim_axis, keepdim=True), dim=point_axis, keepdim=True)
+    furthest_distance = torch.sqrt(furthest_distance_sq)
+    pc = pc * torch.rsqrt(furthest_distance_sq)
     return pc, centroid, furthest_distance
 
 
 def __swig_ptr_from_FloatTensor(x):
     assert x.is_contiguous()
     assert x.dtype == torch.float32
-    return faiss.cast_integer_to_float_ptr(x.storage().data_ptr())
+    return faiss.cast_integer_to_float_ptr(x.data_ptr())
 
 
 def __swig_ptr_from_LongTensor(x):
     assert x.is_contiguous()
     assert x.dtype == torch.int64, 'dtype=%s' % x.dtype
-    return faiss.cast_integer_to_long_ptr(x.storage().data_ptr())
+    return faiss.cast_integer_to_long_ptr(x.data_ptr())
+
+
+# empty flat L2 indices, reused by every search on the same device and dimension
+_index_cache = {}
 
 
-def search_index_pytorch(database, x, k):
+def get_index(d, device):
     """
-    KNN search via Faiss
+    get the cached flat L2 index of dimension d on the given device
+    """
+    key = (device.type, device.index, d)
+    if key not in _index_cache:
+        if device.type == 'cuda':
+            # Faiss places the index on config.device, not on the current device
+            config = faiss.GpuIndexFlatConfig()
+            config.device = device.index
+            _index_cache[key] = faiss.GpuIndexFlatL2(GPU_RES, d, config)
+        else:
+            _index_cache[key] = faiss.IndexFlatL2(d)
+    return _index_cache[key]
+
+
+def search_index_pytorch(database, x, k, D=None, I=None):
+    """
+    KNN search via Faiss. Faiss enqueues on the null stream (see
+    faiss_setup.py), work on other streams has to be synchronized by the caller
     :param
-        database BxNxC
-        x BxMxC
+        database NxC
+        x MxC
+        D, I optional preallocated outputs
     :return
-        D BxMxK
-        I BxMxK
+        D MxK
+        I MxK
     """
-    Dptr = database.storage().data_ptr()
-    if not (x.is_cuda or database.is_cuda):
-        index = faiss.IndexFlatL2(database.size(-1))
-    else:
-        index = faiss.GpuIndexFlatL2(
-            GPU_RES, database.size(-1))  # dimension is 3
-    index.add_c(database.size(0), faiss.cast_integer_to_float_ptr(Dptr))
+    # Faiss reads raw pointers, all tensors must be contiguous already. making
+    # them contiguous here would queue copies on pytorch's stream that the
+    # Faiss stream is not ordered against
+    index = get_index(database.size(-1), database.device)
+    db_ptr = __swig_ptr_from_FloatTensor(database)
+    index.add_c(database.size(0), db_ptr)
 
-    assert x.is_contiguous()
     n, d = x.size()
     assert d == index.d
 
-    D = torch.empty((n, k), dtype=torch.float32, device=x.device)
-    I = torch.empty((n, k), dtype=torch.int64, device=x.device)
+    if D is None:
+        D = torch.empty((n, k), dtype=torch.float32, device=x.device)
+    if I is None:
+        I = torch.empty((n, k), dtype=torch.int64, device=x.device)
 
-    torch.cuda.synchronize()
-    xptr = __swig_ptr_from_FloatTensor(x)
-    Iptr = __swig_ptr_from_LongTensor(I)
-    Dptr = __swig_ptr_from_FloatTensor(D)
-    index.search_c(n, xptr,
-                   k, Dptr, Iptr)
-    torch.cuda.synchronize()
+    x_ptr = __swig_ptr_from_FloatTensor(x)
+    I_ptr = __swig_ptr_from_LongTensor(I)
+    D_ptr = __swig_ptr_from_FloatTensor(D)
+    index.search_c(n, x_ptr,
+                   k, D_ptr, I_ptr)
     index.reset()
     return D, I
 
@@ -86,22 +118,43 @@ class KNN(torch.autograd.Function):
                query: BxMxC
                points: BxNxC
         :return:
-            neighbors_points: BxMxK
             index_batch: BxMxK
+            distance_batch: BxMxK squared L2 distances
         """
-        # selected_gt: BxkxCxM
-        # process each batch independently.
-        index_batch = []
-        distance_batch = []
-        for i in range(points.shape[0]):
-            D_var, I_var = search_index_pytorch(points[i], query[i], k)
-            GPU_RES.syncDefaultStreamCurrentDevice()
-            index_batch.append(I_var)  # M, k
-            distance_batch.append(D_var)  # M, k
+        batch_size, num_query, _ = query.size()
+        if batch_size * num_query * points.size(1) <= TOPK_KNN_MAX_ELEMENTS:
+            # a single batched gemm and topk for the whole batch is much
+            # cheaper than B Faiss searches, especially for low-dimensional data
+            D = _batch_distance_matrix_general(query, points)
+            # B, M, K
+            distance_batch, index_batch = torch.topk(
+                D, k, dim=-1, largest=False, sorted=True)
+            ctx.mark_non_differentiable(index_batch, distance_batch)
+            return index_batch, distance_batch
 
         # B, M, K
-        index_batch = torch.stack(index_batch, dim=0)
-        distance_batch = torch.stack(distance_batch, dim=0)
+        index_batch = torch.empty((batch_size, num_query, k),
+                                  dtype=torch.int64, device=query.device)
+        distance_batch = torch.empty((batch_size, num_query, k),
+                                     dtype=torch.float32, device=query.device)
+        # make the inputs contiguous before the stream sync below, so that
+        # the copies are finished before Faiss reads them
+        query = query.contiguous()
+        points = points.contiguous()
+        # Faiss shares the null stream with pytorch's default stream, so the
+        # searches are ordered with the surrounding ops without any sync.
+        # only a side stream has to be waited for
+        sync_stream = query.is_cuda and \
+            torch.cuda.current_stream() != torch.cuda.default_stream()
+        if sync_stream:
+            torch.cuda.current_stream().synchronize()
+        # process each batch independently.
+        for i in range(batch_size):
+            search_index_pytorch(points[i], query[i], k,
+                                 D=distance_batch[i], I=index_batch[i])
+        if sync_stream:
+            GPU_RES.syncDefaultStream(query.device.index)
+
         ctx.mark_non_differentiable(index_batch, distance_batch)
         return index_batch, distance_batch
 
@@ -148,7 +201,7 @@ class KNN(torch.autograd.Function):
 #     return neighbor_points, index_batch, distance_batch
 
 
-def __batch_distance_matrix_general(A, B):
+def _batch_distance_matrix_general(A, B):
     """
     :param
         A, B [B,N,C], [B,M,C]
@@ -157,8 +210,9 @@ def __batch_distance_matrix_general(A, B):
     """
     r_A = torch.sum(A * A, dim=2, keepdim=True)
     r_B = torch.sum(B * B, dim=2, keepdim=True)
-    m = torch.matmul(A, B.permute(0, 2, 1))
-    D = r_A - 2 * m + r_B.permute(0, 2, 1)
+    # r_A - 2AB^T + r_B^T, the gemm broadcasts r_A into its output and r_B^T
+    # is added in place, so only one [B,N,M] buffer is allocated
+    D = torch.baddbmm(r_A, A, B.permute(0, 2, 1), alpha=-2).add_(r_B.permute(0, 2, 1))
     return D
 
 
@@ -174,21 +228,21 @@ def group_knn(k, query, points, unique=True, NCHW=True):
     :return
         neighbor_points BxCxMxk (if NCHW) or BxMxkxC (otherwise)
         index_batch     BxMxk
-        distance_batch  BxMxk
+        distance_batch  BxMxk squared L2 distances
     """
+    # the distance matrix and the gather work on strided views, no copies
     if NCHW:
-        batch_size, channels, num_points = points.size()
-        points_trans = points.transpose(2, 1).contiguous()
-        query_trans = query.transpose(2, 1).contiguous()
+        points_trans = points.permute(0, 2, 1)
+        query_trans = query.permute(0, 2, 1)
     else:
-        points_trans = points.contiguous()
-        query_trans = query.contiguous()
+        points_trans = points
+        query_trans = query
 
     batch_size, num_points, _ = points_trans.size()
     assert(num_points >= k
            ), "points size must be greater or equal to k"
 
-    D = __batch_distance_matrix_general(query_trans, points_trans)
+    D = _batch_distance_matrix_general(query_trans, points_trans)
     if unique:
         # prepare duplicate entries
         points_np = points_trans.detach().cpu().numpy()
@@ -204,16 +258,19 @@ def group_knn(k, query, points, unique=True, NCHW=True):
         D += torch.max(D) * indices_duplicated
 
     # (B,M,k)
-    distances, point_indices = torch.topk(-D, k, dim=-1, sorted=True)
-    # (B,N,C)->(B,M,N,C), (B,M,k)->(B,M,k,C)
-    knn_trans = torch.gather(points_trans.unsqueeze(1).expand(-1, query_trans.size(1), -1, -1),
-                             2,
-                             point_indices.unsqueeze(-1).expand(-1, -1, -1, points_trans.size(-1)))
+    distances, point_indices = torch.topk(D, k, dim=-1, largest=False, sorted=True)
+    num_query = query_trans.size(1)
+    channels = points_trans.size(-1)
+    # (B,M,k)->(B,M*k,C), gather from (B,N,C) without expanding it to (B,M,N,C)
+    gather_indices = point_indices.view(batch_size, -1, 1).expand(-1, -1, channels)
+    # (B,M,k,C)
+    knn_trans = torch.gather(points_trans, 1, gather_indices).view(
+        batch_size, num_query, k, channels)
 
     if NCHW:
         knn_trans = knn_trans.permute(0, 3, 1, 2)
 
-    return knn_trans, point_indices, -distances
+    return knn_trans, point_indices, distances
 
 
 class GatherFunction(torch.autograd.Function):
@@ -232,15 +289,17 @@ class GatherFunction(torch.autograd.Function):
             (B, C, npoint) tensor
         """
         features = features.contiguous()
-        idx = idx.contiguous()
-        idx = idx.to(dtype=torch.int32)
+        # cast first, so that a strided int64 index is only copied once
+        idx = idx.to(dtype=torch.int32).contiguous()
 
         B, npoint = idx.size()
         _, C, N = features.size()
 
+        # written in place by the kernel. a fresh tensor every call, the
+        # result is handed to autograd and may be alive across calls
         output = torch.empty(
             B, C, npoint, dtype=features.dtype, device=features.device)
-        output = sampling.gather_forward(
+        sampling.gather_forward(
             B, C, N, npoint, features, idx, output
         )
 
@@ -256,7 +315,7 @@ class GatherFunction(torch.autograd.Function):
 
         grad_features = torch.zeros(
             B, ctx.C, ctx.N, dtype=grad_out.dtype, device=grad_out.device)
-        grad_features = sampling.gather_backward(
+        sampling.gather_backward(
             B, ctx.C, ctx.N, npoint, grad_out.contiguous(), idx, grad_features
         )
 
@@ -276,7 +335,7 @@ class FurthestPointSampling(torch.autograd.Function):
         Parameters
         ----------
         xyz : torch.Tensor
-            (B, N, 3) tensor where N > npoint
+            (B, 3, N) contiguous tensor where N > npoint
         npoint : int32
             number of features in the sampled set
         Returns
@@ -285,10 +344,12 @@ class FurthestPointSampling(torch.autograd.Function):
             (B, npoint) tensor containing the indices
 
         """
-        B, N, _ = xyz.size()
+        B, _, N = xyz.size()
 
         idx = torch.empty([B, npoint], dtype=torch.int32, device=xyz.device)
-        temp = torch.full([B, N], 1e10, dtype=torch.float32, device=xyz.device)
+        temp = torch.full([B, N], float('inf'),
+                          dtype=torch.float16 if FPS_HALF_TEMP else torch.float32,
+                          device=xyz.device)
 
         sampling.furthest_sampling(
             B, N, npoint, xyz, temp, idx
@@ -311,13 +372,14 @@ def furthest_point_sample(xyz, npoint, NCHW=True):
         torch.FloatTensor
             (B, npoint, 3) or (B, 3, npoint) point sets"""
     assert(xyz.dim() == 3), "input for furthest sampling must be a 3D-tensor, but xyz.size() is {}".format(xyz.size())
-    # need transpose
-    if NCHW:
-        xyz = xyz.transpose(2, 1).contiguous()
+    # the sampling kernel and gather_points both take (B, 3, N)
+    if not NCHW:
+        xyz = xyz.transpose(2, 1)
+    xyz = xyz.contiguous()
 
-    assert(xyz.size(2) == 3), "furthest sampling is implemented for 3D points"
+    assert(xyz.size(1) == 3), "furthest sampling is implemented for 3D points"
     idx = __furthest_point_sample(xyz, npoint)
-    sampled_pc = gather_points(xyz.transpose(2, 1).contiguous(), idx)
+    sampled_pc = gather_points(xyz, idx)
     if not NCHW:
         sampled_pc = sampled_pc.transpose(2, 1).contiguous()
     return idx, sampled_pc
@@ -330,7 +392,8 @@ if __name__ == '__main__':
     pc = pc[:, :3]
     print("{} input points".format(pc.shape[0]))
     save_ply(pc, "./input.ply", colors=None, normals=None)
-    pc = torch.from_numpy(pc).requires_grad_().to(cuda0).unsqueeze(0)
+    pc = torch.from_numpy(pc).pin_memory()
+    pc = pc.to(cuda0, non_blocking=True).requires_grad_().unsqueeze(0)
     pc = pc.transpose(2, 1)
 
     # test furthest point
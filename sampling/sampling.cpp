@@ -31,6 +31,7 @@ at::Tensor furthest_sampling_forward(
 {
   CHECK_INPUT(input);
   CHECK_INPUT(temp);
+  AT_ASSERTM(input.dim() == 3 && input.size(1) == 3, "input must be a (b, 3, n) tensor");
   return furthest_sampling_cuda_forward(b, n, m, input, temp, idx);
 }
 
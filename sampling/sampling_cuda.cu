@@ -23,30 +23,55 @@ __device__ void __update(float *__restrict__ dists, int *__restrict__ dists_i,
     dists_i[idx1] = v2 > v1 ? i2 : i1;
 }
 
+#define GATHER_POINT_TILE 32
+
 // input: points(b, c, n) idx(b, m)
 // output: out(b, c, m)
+// threadIdx.x runs over a tile of GATHER_POINT_TILE sampled points and
+// threadIdx.y over the channels. every index of the tile is loaded once into
+// shared memory and reused for all channels of the block, which are all of
+// them for up to TOTAL_THREADS / GATHER_POINT_TILE channels
 template <typename scalar_t>
 __global__ void gather_points_forward_kernel(int b, int c, int n, int m,
                      const scalar_t *__restrict__ points,
                      const int *__restrict__ idx,
                      scalar_t *__restrict__ out) {
+    __shared__ int s_idx[GATHER_POINT_TILE];
     for (int i = blockIdx.x; i < b; i += gridDim.x) {
-        for (int l = blockIdx.y; l < c; l += gridDim.y) {
-            for (int j = threadIdx.x; j < m; j += blockDim.x) {
-            int a = idx[i * m + j];
-            out[(i * c + l) * m + j] = points[(i * c + l) * n + a];
+        for (int j0 = blockIdx.y * blockDim.x; j0 < m; j0 += gridDim.y * blockDim.x) {
+            const int j = j0 + threadIdx.x;
+            if (threadIdx.y == 0 && j < m)
+                s_idx[threadIdx.x] = idx[i * m + j];
+            __syncthreads();
+            if (j < m) {
+                const int a = s_idx[threadIdx.x];
+                for (int l = blockIdx.z * blockDim.y + threadIdx.y; l < c; l += gridDim.z * blockDim.y)
+                    out[(i * c + l) * m + j] = points[(i * c + l) * n + a];
             }
+            __syncthreads();
         }
     }
 }
 
+// blocks of (points, channels) threads covering (b, m, c). the point tile is
+// narrow so that the block spends its threads on the channels
+inline void gather_points_launch_config(int b, int c, int npoints, dim3 &blocks, dim3 &threads) {
+    threads = dim3(GATHER_POINT_TILE,
+                   std::max(std::min(c, TOTAL_THREADS / GATHER_POINT_TILE), 1), 1);
+    blocks = dim3(b,
+                  min((npoints + threads.x - 1) / threads.x, 65535u),
+                  min((c + threads.y - 1) / threads.y, 65535u));
+}
+
 at::Tensor gather_points_cuda_forward(int b, int c, int n, int npoints,
                   at::Tensor points, at::Tensor idx,
                   at::Tensor out) {
 
     cudaError_t err;
+    dim3 blocks, threads;
+    gather_points_launch_config(b, c, npoints, blocks, threads);
     AT_DISPATCH_FLOATING_TYPES_AND_HALF(points.type(), "gather_points_cuda_forward", ([&] {
-            gather_points_forward_kernel<scalar_t><<<dim3(b, c, 1), opt_n_threads(npoints)>>>(
+            gather_points_forward_kernel<scalar_t><<<blocks, threads>>>(
             b, c, n, npoints,
             points.data<scalar_t>(),
             idx.data<int32_t>(),
@@ -63,18 +88,26 @@ at::Tensor gather_points_cuda_forward(int b, int c, int n, int npoints,
 
 // input: grad_out(b, c, m) idx(b, m)
 // output: grad_points(b, c, n)
+// same thread layout as gather_points_forward_kernel
 template <typename scalar_t>
 __global__ void gather_points_backward_kernel(int b, int c, int n, int m,
                       scalar_t *__restrict__ grad_out,
                       const int *__restrict__ idx,
                       scalar_t *__restrict__ grad_points) {
+    __shared__ int s_idx[GATHER_POINT_TILE];
     for (int i = blockIdx.x; i < b; i += gridDim.x) {
-        for (int l = blockIdx.y; l < c; l += gridDim.y) {
-            for (int j = threadIdx.x; j < m; j += blockDim.x) {
-            int a = idx[i * m + j];
-            atomicAdd(grad_points + (i * c + l) * n + a,
-                  grad_out[(i * c + l) * m + j]);
+        for (int j0 = blockIdx.y * blockDim.x; j0 < m; j0 += gridDim.y * blockDim.x) {
+            const int j = j0 + threadIdx.x;
+            if (threadIdx.y == 0 && j < m)
+                s_idx[threadIdx.x] = idx[i * m + j];
+            __syncthreads();
+            if (j < m) {
+                const int a = s_idx[threadIdx.x];
+                for (int l = blockIdx.z * blockDim.y + threadIdx.y; l < c; l += gridDim.z * blockDim.y)
+                    atomicAdd(grad_points + (i * c + l) * n + a,
+                          grad_out[(i * c + l) * m + j]);
             }
+            __syncthreads();
         }
     }
 }
@@ -83,8 +116,10 @@ __global__ void gather_points_backward_kernel(int b, int c, int n, int m,
 at::Tensor gather_points_cuda_backward(int b, int c, int n, int npoints,
                        at::Tensor grad_out, at::Tensor idx, at::Tensor grad_points) {
     cudaError_t err;
+    dim3 blocks, threads;
+    gather_points_launch_config(b, c, npoints, blocks, threads);
     AT_DISPATCH_FLOATING_TYPES_AND_HALF(grad_out.type(), "gather_points_cuda_backward", ([&] {
-        gather_points_backward_kernel<scalar_t><<<dim3(b, c, 1), opt_n_threads(npoints)>>>(
+        gather_points_backward_kernel<scalar_t><<<blocks, threads>>>(
             b, c, n, npoints,
             grad_out.data<scalar_t>(),
             idx.data<int32_t>(),
@@ -100,22 +135,60 @@ at::Tensor gather_points_cuda_backward(int b, int c, int n, int npoints,
 }
 
 
-template <unsigned int block_size>
+// keep the larger distance, ties go to the candidate of the lower thread,
+// i.e. the same point a shared memory tree reduction would select.
+// thread t only visits points k with k % n_threads == t
+__device__ __forceinline__ void __argmax_merge(float &v1, int &i1, float v2, int i2,
+             unsigned int n_threads) {
+    if (v2 > v1 || (v2 == v1 && (i2 % n_threads) < (i1 % n_threads))) {
+        v1 = v2;
+        i1 = i2;
+    }
+}
+
+// argmax over the lanes of a warp (or of the whole block if it is smaller
+// than a warp), the result ends up in lane 0
+__device__ __forceinline__ void __warp_argmax(float &best, int &besti) {
+    const unsigned int width = min(blockDim.x, 32u);
+    const unsigned int mask = width == 32 ? 0xffffffff : (1u << width) - 1;
+    for (unsigned int offset = width >> 1; offset > 0; offset >>= 1) {
+        float v2 = __shfl_down_sync(mask, best, offset, width);
+        int i2 = __shfl_down_sync(mask, besti, offset, width);
+        __argmax_merge(best, besti, v2, i2, blockDim.x);
+    }
+}
+
+// number of points furthest point sampling keeps in shared memory, independent
+// of the block size. 3 x 4000 floats stay below the 48KB static shared memory
+// limit and cover the typical 3PU inputs (patches of up to a few thousand points)
+#define FPS_BUFFER_SIZE 4000
+
+template <unsigned int block_size, typename temp_t>
 __global__ void furthest_point_sampling_forward_kernel(int b, int n, int m,
-    const float * __restrict__ input, float * __restrict__ temp, int * __restrict__ idx) {
+    const float * __restrict__ input, temp_t * __restrict__ temp, int * __restrict__ idx) {
+    // input: (b, 3, n) coordinates stored plane by plane, so that neighboring
+    // threads read neighboring floats of each axis
     // temp: (nxb) the closest distance from each of the n points to the existing set
     if (m <= 0) return;
-    __shared__ float dists[block_size];
-    __shared__ int dists_i[block_size];
-    const unsigned int buffer_size = block_size;
-    __shared__ float buf[block_size*3];
+    // one partial argmax per warp
+    __shared__ float dists[(block_size + 31) / 32];
+    __shared__ int dists_i[(block_size + 31) / 32];
+    __shared__ int best_i;
+    const unsigned int lane = threadIdx.x & 31;
+    const unsigned int warp = threadIdx.x >> 5;
+    const unsigned int n_warps = (blockDim.x + 31) >> 5;
+    const unsigned int buffer_size = FPS_BUFFER_SIZE;
+    // x, y and z planes of the first buffer_size points
+    __shared__ float buf[FPS_BUFFER_SIZE*3];
     for (int i=blockIdx.x; i<b; i+=gridDim.x){
         int old=0;
         // first out of sought m points is point0
         if (threadIdx.x==0) idx[i*m+0]=old;
         // fill buffer in the shared memory with input *once* for faster read
-        for (int j=threadIdx.x;j<min(buffer_size,n)*3;j+=blockDim.x){
-          buf[j]=input[i*n*3+j];
+        for (int j=threadIdx.x;j<min(buffer_size,n);j+=blockDim.x){
+          buf[j]=input[i*3*n+j];
+          buf[buffer_size+j]=input[i*3*n+n+j];
+          buf[2*buffer_size+j]=input[i*3*n+2*n+j];
         }
         __syncthreads();
         // iteratively add m points
@@ -123,138 +196,153 @@ __global__ void furthest_point_sampling_forward_kernel(int b, int n, int m,
               int besti=0;
               float best=-1;
               // position of the last point
-              float x1=input[i*n*3+old*3+0];
-              float y1=input[i*n*3+old*3+1];
-              float z1=input[i*n*3+old*3+2];
+              float x1=input[i*3*n+old];
+              float y1=input[i*3*n+n+old];
+              float z1=input[i*3*n+2*n+old];
               // Neither do i understand this loop
               for (int k=threadIdx.x;k<n;k+=blockDim.x){
-                float td=temp[blockIdx.x*n+k];
+                float td=static_cast<float>(temp[blockIdx.x*n+k]);
                 float x2,y2,z2;
                 // if buffer not filled, set new point an input point
                 if (k<buffer_size){
-                  x2=buf[k*3+0];
-                  y2=buf[k*3+1];
-                  z2=buf[k*3+2];
+                  x2=buf[k];
+                  y2=buf[buffer_size+k];
+                  z2=buf[2*buffer_size+k];
                 }else{
-                  x2=input[i*n*3+k*3+0];
-                  y2=input[i*n*3+k*3+1];
-                  z2=input[i*n*3+k*3+2];
+                  x2=input[i*3*n+k];
+                  y2=input[i*3*n+n+k];
+                  z2=input[i*3*n+2*n+k];
                 }
                 float d=(x2-x1)*(x2-x1)+(y2-y1)*(y2-y1)+(z2-z1)*(z2-z1);
-                float d2=min(d,td);
+                // round through temp_t so that the argmax compares exactly
+                // the distances that are stored in temp
+                float d2=static_cast<float>(static_cast<temp_t>(min(d,td)));
                 if (d2!=td)
-                  temp[blockIdx.x*n+k]=d2;
+                  temp[blockIdx.x*n+k]=static_cast<temp_t>(d2);
                 if (d2>best){
                   best=d2;
                   besti=k;
                 }
               }
-              dists[threadIdx.x]=best;
-              dists_i[threadIdx.x]=besti;
-              // u from 0~log2(block_size)
-              for (int u=0;(1<<u)<blockDim.x;u++){
-                __syncthreads();
-                // maximize pairwise between the current thread and
-                // the sibling thread in the binary-tree
-                if (threadIdx.x<(blockDim.x>>(u+1))){
-                  int i1=(threadIdx.x*2)<<u;
-                  int i2=(threadIdx.x*2+1)<<u;
-                  if (dists[i1]<dists[i2]){
-                    dists[i1]=dists[i2];
-                    dists_i[i1]=dists_i[i2];
-                  }
-                }
+              // reduce within each warp with shuffles, then across warps
+              __warp_argmax(best, besti);
+              if (lane==0){
+                dists[warp]=best;
+                dists_i[warp]=besti;
               }
               __syncthreads();
-              old=dists_i[0];
+              if (warp==0){
+                best=lane<n_warps ? dists[lane] : -1;
+                besti=lane<n_warps ? dists_i[lane] : 0;
+                __warp_argmax(best, besti);
+                if (lane==0)
+                  best_i=besti;
+              }
+              __syncthreads();
+              old=best_i;
               if (threadIdx.x==0)
                 idx[i*m+j]=old;
             }
           }
         }
 
-at::Tensor furthest_sampling_cuda_forward(int b, int n, int m,
-    at::Tensor input, at::Tensor temp, at::Tensor idx) {
+template <typename temp_t>
+void furthest_sampling_launch(int b, int n, int m,
+    const float *input, temp_t *temp, int *idx) {
 
     unsigned int n_threads = opt_n_threads(n);
     unsigned int n_blocks = min(32, (n*b + n_threads/2)/n_threads);
     switch (n_threads) {
       case 512:
-      furthest_point_sampling_forward_kernel<512><<<n_blocks, n_threads>>>(
-          b, n, m, input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+      furthest_point_sampling_forward_kernel<512, temp_t><<<n_blocks, n_threads>>>(
+          b, n, m, input,
+          temp,
+          idx);
       break;
       case 256:
-      furthest_point_sampling_forward_kernel<256><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<256, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       case 128:
-      furthest_point_sampling_forward_kernel<128><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<128, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       case 64:
-      furthest_point_sampling_forward_kernel<64><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<64, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       case 32:
-      furthest_point_sampling_forward_kernel<32><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<32, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       case 16:
-      furthest_point_sampling_forward_kernel<16><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<16, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       case 8:
-      furthest_point_sampling_forward_kernel<8><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<8, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       case 4:
-      furthest_point_sampling_forward_kernel<4><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<4, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       case 2:
-      furthest_point_sampling_forward_kernel<2><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<2, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       case 1:
-      furthest_point_sampling_forward_kernel<1><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<1, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       break;
       default:
-      furthest_point_sampling_forward_kernel<512><<<n_blocks, n_threads>>>(
+      furthest_point_sampling_forward_kernel<512, temp_t><<<n_blocks, n_threads>>>(
           b, n, m,
-          input.data<float>(),
-          temp.data<float>(),
-          idx.data<int32_t>());
+          input,
+          temp,
+          idx);
       }
+}
+
+at::Tensor furthest_sampling_cuda_forward(int b, int n, int m,
+    at::Tensor input, at::Tensor temp, at::Tensor idx) {
+
+    // temp holds the running minimum distances, it may be stored in half
+    // precision, distances are always computed in float
+    if (temp.type().scalarType() == at::ScalarType::Half) {
+      furthest_sampling_launch<at::Half>(b, n, m,
+          input.data<float>(), temp.data<at::Half>(), idx.data<int32_t>());
+    } else {
+      furthest_sampling_launch<float>(b, n, m,
+          input.data<float>(), temp.data<float>(), idx.data<int32_t>());
+    }
 
     cudaError_t err = cudaGetLastError();
     if (cudaSuccess != err) {